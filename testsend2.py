@@ -1,8 +1,35 @@
+import asyncio
+import collections
+import dbus
 import gatt
 import gpsd
 import struct
+import threading
 import time
 
+# Pack as 8 bytes (little-endian int32 lat, lon in 1e-7 degrees)
+_pack_ints = struct.Struct('<ii').pack
+_FIX_SIZE = 8
+_SCALE = 10_000_000
+
+def pack_fix(lat, lon):
+    return _pack_ints(round(lat * _SCALE), round(lon * _SCALE))
+
+# Default ATT MTU until the client reports a larger one
+DEFAULT_MTU = 23
+
+# Seconds between gpsd polls
+GPS_POLL_INTERVAL = 0.25
+
+# A fix older than this many seconds is treated as lost
+GPS_MAX_AGE = 5.0
+
+# Seconds between GPS samples for notifications
+NOTIFY_INTERVAL = 1.0
+
+# Longest a queued fix may wait before its batch is sent anyway
+MAX_BATCH_AGE = 5 * NOTIFY_INTERVAL
+
 # Connect to GPS
 gpsd.connect()
 
@@ -10,9 +37,39 @@ gpsd.connect()
 adapter = gatt.DeviceManager(adapter_name='hci0')
 
 class RobotPeripheral(gatt.Device):
+    # Latest (lat, lon, monotonic time) fix, shared by all characteristics
+    _latest = None
+
     def __init__(self, mac_address, manager):
         super().__init__(mac_address=mac_address, manager=manager)
 
+    def current_fix(self):
+        # (lat, lon) of the latest fix, or None if there is none or it is stale
+        latest = self._latest
+        if latest is None or time.monotonic() - latest[2] > GPS_MAX_AGE:
+            return None
+        return latest[0], latest[1]
+
+    def poll_gps(self):
+        # Runs in its own thread so gpsd latency never stalls the GATT loop
+        failing = False
+        while True:
+            try:
+                packet = gpsd.get_current()
+            except Exception as e:
+                # Report only the first failure of a run, not every poll
+                if not failing:
+                    print(f"GPS error: {e}")
+                    failing = True
+            else:
+                if failing:
+                    print("GPS recovered")
+                    failing = False
+                # Mode 2/3 is a 2D/3D fix; anything lower has no position
+                if packet.mode >= 2:
+                    self._latest = (packet.lat, packet.lon, time.monotonic())
+            time.sleep(GPS_POLL_INTERVAL)
+
 class GPSService(gatt.Service):
     UUID = '12345678-1234-5678-1234-56789abcdef0'
 
@@ -21,27 +78,63 @@ class GPSCharacteristic(gatt.Characteristic):
 
     def __init__(self, service):
         super().__init__(service, self.UUID, ['read', 'notify'])
+        self.mtu = DEFAULT_MTU
+        self.ring = collections.deque()
+        self.ring_started = 0.0
+        self.notify_task = None
+        self.last_fix = None
+
+    def batch_size(self):
+        # ATT notification header takes 3 bytes of the MTU
+        return max(1, (self.mtu - 3) // _FIX_SIZE)
+
+    def update_mtu(self, options):
+        # BlueZ reports the negotiated MTU in the read options
+        mtu = options.get('mtu')
+        if mtu:
+            self.mtu = int(mtu)
 
     def ReadValue(self, options):
-        packet = gpsd.get_current()
-        lat = packet.lat
-        lon = packet.lon
-        # Pack as 8 bytes (float32)
-        data = struct.pack('ff', lat, lon)
-        return [c for c in data]
+        self.update_mtu(options)
+        fix = robot.current_fix()
+        # An empty value tells the client there is no current fix
+        if fix is None:
+            return dbus.ByteArray(b'')
+        return dbus.ByteArray(pack_fix(*fix))
 
     def StartNotify(self):
         print("Client subscribed to GPS updates")
-        self.notify_loop()
+        if self.notify_task is None:
+            self.last_fix = None
+            self.ring.clear()
+            self.notify_task = adapter.run_loop.create_task(self.notify_loop())
+
+    def StopNotify(self):
+        if self.notify_task is not None:
+            self.notify_task.cancel()
+            self.notify_task = None
 
-    def notify_loop(self):
-        packet = gpsd.get_current()
-        lat = packet.lat
-        lon = packet.lon
-        data = struct.pack('ff', lat, lon)
-        self.PropertiesChanged({"Value": [c for c in data]}, [])
-        # Notify again after 1 sec
-        adapter.run_loop.call_later(1.0, self.notify_loop)
+    async def notify_loop(self):
+        while True:
+            # Stale or missing fixes are not queued
+            cur = robot.current_fix()
+            fix = pack_fix(*cur) if cur else None
+            moved = fix is not None and fix != self.last_fix
+            now = time.monotonic()
+            if moved:
+                self.last_fix = fix
+                if not self.ring:
+                    self.ring_started = now
+                self.ring.append(fix)
+            # Ship a full batch, what is pending once the fix stops changing,
+            # or whatever has waited MAX_BATCH_AGE
+            if self.ring and (not moved or
+                              len(self.ring) >= self.batch_size() or
+                              now - self.ring_started >= MAX_BATCH_AGE):
+                data = b''.join(self.ring)
+                self.ring.clear()
+                self.PropertiesChanged({"Value": dbus.ByteArray(data)}, [])
+            await asyncio.sleep(NOTIFY_INTERVAL)
 
 # Initialize device (peripheral)
 robot = RobotPeripheral(mac_address=None, manager=adapter)
@@ -50,4 +143,5 @@ robot = RobotPeripheral(mac_address=None, manager=adapter)
 gps_service = GPSService(robot)
 gps_char = GPSCharacteristic(gps_service)
 
+threading.Thread(target=robot.poll_gps, daemon=True).start()
 adapter.run()
@@ -5,25 +5,109 @@ Can run in background with logging
 """
 
 import socket
-import json
+import selectors
+import struct
 import time
-import subprocess
 import os
 import sys
 import signal
+import threading
 import logging
+import dbus
+import dbus.service
+import msgpack
 from gps import *
 from datetime import datetime
 
+# Each frame is a msgpack map prefixed with its length (little-endian uint16)
+_FRAME_LEN = struct.Struct('<H').pack
+
+def encode_frame(gps_data):
+    """Encode a GPS fix as a length-prefixed msgpack map"""
+    frame = msgpack.packb(gps_data, use_bin_type=True)
+    return _FRAME_LEN(len(frame)) + frame
+
+BLUEZ = 'org.bluez'
+ADAPTER_PATH = '/org/bluez/hci0'
+PROFILE_PATH = '/gps_tracker/serial'
+# Private profile UUID, so BlueZ applies none of its built-in SPP defaults
+# (which include opening its own RFCOMM listener)
+PROFILE_UUID = '224e4d2a-e7e5-4bf7-a694-c5e34ae646c2'
+
+# SDP record advertising Serial Port on our RFCOMM channel
+SPP_RECORD = """<?xml version="1.0" encoding="UTF-8" ?>
+<record>
+  <attribute id="0x0001">
+    <sequence><uuid value="0x1101" /></sequence>
+  </attribute>
+  <attribute id="0x0004">
+    <sequence>
+      <sequence><uuid value="0x0100" /></sequence>
+      <sequence><uuid value="0x0003" /><uint8 value="0x{channel:02x}" /></sequence>
+    </sequence>
+  </attribute>
+  <attribute id="0x0005">
+    <sequence><uuid value="0x1002" /></sequence>
+  </attribute>
+  <attribute id="0x0009">
+    <sequence>
+      <sequence><uuid value="0x1101" /><uint16 value="0x0102" /></sequence>
+    </sequence>
+  </attribute>
+  <attribute id="0x0100">
+    <text value="Serial Port" />
+  </attribute>
+</record>
+"""
+
+class SerialProfile(dbus.service.Object):
+    """BlueZ profile object backing the Serial Port SDP record"""
+
+    # BlueZ needs an object at the profile path. It opens no listener for
+    # this profile, and with no D-Bus main loop these are never dispatched,
+    # so they are empty stubs.
+
+    @dbus.service.method('org.bluez.Profile1', in_signature='', out_signature='')
+    def Release(self):
+        pass
+
+    @dbus.service.method('org.bluez.Profile1', in_signature='oha{sv}', out_signature='')
+    def NewConnection(self, device, fd, properties):
+        pass
+
+    @dbus.service.method('org.bluez.Profile1', in_signature='o', out_signature='')
+    def RequestDisconnection(self, device):
+        pass
+
 class DaemonGPSTracker:
+    # Seconds between GPS frames queued for the client
+    EMIT_INTERVAL = 2.0
+    # A fix older than this many seconds is treated as lost
+    GPS_MAX_AGE = 5.0
+    # Flush the transmit buffer once it holds this many frames, or once its
+    # oldest frame has waited this many seconds (several emit intervals)
+    TX_BATCH_FRAMES = 4
+    TX_FLUSH_INTERVAL = 3 * EMIT_INTERVAL
+    # Kernel send/receive buffer size for RFCOMM sockets
+    SOCK_BUF_SIZE = 65536
+
     def __init__(self, log_file='/var/log/gps_tracker.log', pid_file='/var/run/gps_tracker.pid'):
         self.log_file = log_file
         self.pid_file = pid_file
         self.server_sock = None
         self.client_sock = None
+        self.accept_sel = None
         self.gps_session = None
+        self._latest = (None, 0.0)
         self.running = False
+        self._stop = threading.Event()
         self.channel = 1
+        self._tx_buf = bytearray()
+        self._tx_frames = 0
+        self._tx_deadline = 0.0
+        self._bus = None
+        self._profile = None
+        self._profile_path = None
 
         # Setup logging
         logging.basicConfig(
@@ -33,6 +117,10 @@ class DaemonGPSTracker:
             datefmt='%Y-%m-%d %H:%M:%S'
         )
         self.logger = logging.getLogger(__name__)
+        # Bound methods for the transmit loop, used with lazy %-formatting
+        self._info = self.logger.info
+        self._warning = self.logger.warning
+        self._error = self.logger.error
 
     def log(self, message, level='info'):
         """Log message"""
@@ -89,23 +177,34 @@ class DaemonGPSTracker:
         """Handle termination signals"""
         self.log(f"Received signal {signum}, shutting down...")
         self.running = False
+        self._stop.set()
         self.cleanup()
         sys.exit(0)
 
+    def get_bus(self):
+        """Get the system D-Bus connection"""
+        if self._bus is None:
+            self._bus = dbus.SystemBus()
+        return self._bus
+
+    def profile_manager(self):
+        """Get the BlueZ profile manager interface"""
+        return dbus.Interface(
+            self.get_bus().get_object(BLUEZ, '/org/bluez'),
+            'org.bluez.ProfileManager1'
+        )
+
     def make_discoverable(self):
         """Make Bluetooth discoverable"""
         try:
-            # Power on Bluetooth
-            subprocess.run(['hciconfig', 'hci0', 'up'], check=False)
-            time.sleep(1)
-
-            # Make discoverable and pairable using hciconfig
-            subprocess.run(['hciconfig', 'hci0', 'piscan'], check=True)
-
-            # Also try with bluetoothctl for persistence
-            subprocess.run(['bluetoothctl'],
-                         input=b'power on\ndiscoverable on\npairable on\nexit\n',
-                         timeout=5, check=False)
+            adapter = dbus.Interface(
+                self.get_bus().get_object(BLUEZ, ADAPTER_PATH),
+                'org.freedesktop.DBus.Properties'
+            )
+            adapter.Set('org.bluez.Adapter1', 'Powered', dbus.Boolean(True))
+            adapter.Set('org.bluez.Adapter1', 'DiscoverableTimeout', dbus.UInt32(0))
+            adapter.Set('org.bluez.Adapter1', 'Discoverable', dbus.Boolean(True))
+            adapter.Set('org.bluez.Adapter1', 'Pairable', dbus.Boolean(True))
 
             self.log("Device is discoverable")
             return True
@@ -116,22 +215,34 @@ class DaemonGPSTracker:
     def register_sdp_service(self):
         """Register SDP service"""
         try:
-            subprocess.run(['sdptool', 'del', 'SP'],
-                         stderr=subprocess.DEVNULL, check=False)
+            if self._profile_path:
+                return True
 
-            result = subprocess.run(
-                ['sdptool', 'add', '--channel=' + str(self.channel), 'SP'],
-                capture_output=True
-            )
+            bus = self.get_bus()
+            if self._profile is None:
+                self._profile = SerialProfile(bus, PROFILE_PATH)
 
-            if result.returncode == 0:
-                self.log("SDP service registered")
-                return True
-            return False
+            # Publish the SDP record only; the channel lives in the record
+            self.profile_manager().RegisterProfile(PROFILE_PATH, PROFILE_UUID, {
+                'Name': 'Serial Port',
+                'ServiceRecord': SPP_RECORD.format(channel=self.channel),
+            })
+            self._profile_path = PROFILE_PATH
+
+            self.log("SDP service registered")
+            return True
         except Exception as e:
             self.log(f"SDP error: {e}", 'warning')
             return False
 
+    def tune_socket(self, sock):
+        """Enlarge socket buffers so bursts of frames don't block"""
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, self.SOCK_BUF_SIZE)
+            except OSError as e:
+                self.log(f"Socket buffer error: {e}", 'warning')
+
     def setup_bluetooth(self):
         """Setup Bluetooth server"""
         try:
@@ -141,7 +252,10 @@ class DaemonGPSTracker:
                 socket.BTPROTO_RFCOMM
             )
             self.server_sock.bind(("", self.channel))
+            self.tune_socket(self.server_sock)
             self.server_sock.listen(1)
+            self.accept_sel = selectors.EpollSelector()
+            self.accept_sel.register(self.server_sock, selectors.EVENT_READ)
             self.log(f"Bluetooth server listening on channel {self.channel}")
             return True
         except Exception as e:
@@ -162,10 +276,14 @@ class DaemonGPSTracker:
         """Accept client connection"""
         try:
             self.log("Waiting for connection...")
-            self.server_sock.settimeout(None)
-            self.client_sock, client_info = self.server_sock.accept()
-            self.log(f"Connected to: {client_info}")
-            return True
+            # Wake up every second so a shutdown request is noticed
+            while self.running:
+                if self.accept_sel.select(timeout=1.0):
+                    self.client_sock, client_info = self.server_sock.accept()
+                    self.tune_socket(self.client_sock)
+                    self.log(f"Connected to: {client_info}")
+                    return True
+            return False
         except Exception as e:
             self.log(f"Connection error: {e}", 'error')
             return False
@@ -174,40 +292,102 @@ class DaemonGPSTracker:
         """Get GPS data"""
         try:
             report = self.gps_session.next()
-            if report['class'] == 'TPV':
-                if hasattr(report, 'lat') and hasattr(report, 'lon'):
-                    return {
-                        'type': 'gps',
-                        'latitude': report.lat,
-                        'longitude': report.lon,
-                        'altitude': getattr(report, 'alt', 0),
-                        'speed': getattr(report, 'speed', 0),
-                        'timestamp': getattr(report, 'time', '')
-                    }
+            # Most reports are SKY/ATT etc., so reject those first
+            fields = report.__dict__
+            if fields.get('class') != 'TPV':
+                return None
+            try:
+                lat = report.lat
+                lon = report.lon
+            except AttributeError:
+                return None
+            return {
+                'type': 'gps',
+                'latitude': lat,
+                'longitude': lon,
+                'altitude': fields.get('alt', 0),
+                'speed': fields.get('speed', 0),
+                'timestamp': fields.get('time', '')
+            }
+        except StopIteration:
+            raise
         except:
             pass
         return None
 
+    def read_gps(self):
+        """Read GPS reports into the latest-fix slot"""
+        while not self._stop.is_set():
+            try:
+                gps_data = self.get_gps_data()
+            except StopIteration:
+                self._warning("GPS stream closed")
+                return
+            if gps_data:
+                # Replace the whole tuple so readers never see a partial update
+                self._latest = (gps_data, time.monotonic())
+
+    def flush_tx(self):
+        """Send buffered frames in a single write"""
+        if self._tx_buf:
+            self.client_sock.sendall(self._tx_buf)
+            self._tx_buf.clear()
+        self._tx_frames = 0
+
     def send_gps_data(self):
         """Send GPS data loop"""
-        self.log("Starting GPS transmission")
+        self._info("Starting GPS transmission")
+        self._tx_buf.clear()
+        self._tx_frames = 0
 
-        while self.running:
-            try:
-                gps_data = self.get_gps_data()
+        sel = selectors.DefaultSelector()
+        sel.register(self.client_sock, selectors.EVENT_READ)
 
-                if gps_data and self.client_sock:
-                    json_str = json.dumps(gps_data) + '\n'
-                    try:
-                        self.client_sock.send(json_str.encode('utf-8'))
-                    except:
-                        self.log("Connection lost", 'warning')
+        sent_at = 0.0
+        next_emit = time.monotonic() + self.EMIT_INTERVAL
+
+        try:
+            while self.running:
+                try:
+                    # Wake for the next frame, or earlier if buffered
+                    # frames are due to be flushed
+                    wake = next_emit
+                    if self._tx_buf:
+                        wake = min(wake, self._tx_deadline)
+                    timeout = max(0.0, wake - time.monotonic())
+                    if sel.select(timeout) and not self.client_sock.recv(1024):
+                        self._info("Client closed the connection")
                         break
 
-                time.sleep(2)
-            except Exception as e:
-                self.log(f"Send error: {e}", 'error')
-                time.sleep(2)
+                    now = time.monotonic()
+                    if now >= next_emit:
+                        next_emit = now + self.EMIT_INTERVAL
+
+                        # Only queue fresh fixes that arrived since the last frame
+                        gps_data, stamp = self._latest
+                        if (gps_data and stamp > sent_at and
+                                now - stamp <= self.GPS_MAX_AGE):
+                            sent_at = stamp
+                            if not self._tx_buf:
+                                self._tx_deadline = now + self.TX_FLUSH_INTERVAL
+                            self._tx_buf += encode_frame(gps_data)
+                            self._tx_frames += 1
+
+                    if self._tx_buf and (self._tx_frames >= self.TX_BATCH_FRAMES or
+                                         now >= self._tx_deadline):
+                        self.flush_tx()
+                # A dropped link surfaces from recv() as well as from send()
+                except (BrokenPipeError, ConnectionResetError):
+                    self._info("Client closed the connection")
+                    break
+                except OSError as e:
+                    self._warning("Connection lost: %s", e)
+                    break
+                except Exception as e:
+                    self._error("Send error: %s", e)
+                    self._stop.wait(2)
+        finally:
+            sel.close()
 
     def run(self):
         """Main run loop"""
@@ -218,9 +398,12 @@ class DaemonGPSTracker:
             return
 
         self.register_sdp_service()
-        self.setup_gps()
 
         self.running = True
+        self._stop.clear()
+
+        if self.setup_gps():
+            threading.Thread(target=self.read_gps, daemon=True).start()
 
         while self.running:
             if self.accept_connection():
@@ -229,17 +412,19 @@ class DaemonGPSTracker:
                     self.client_sock.close()
                     self.client_sock = None
                 self.log("Client disconnected, waiting for new connection...")
-            time.sleep(1)
+            self._stop.wait(1.0)
 
     def cleanup(self):
         """Cleanup resources"""
         self.running = False
+        self._stop.set()
 
-        try:
-            subprocess.run(['sdptool', 'del', 'SP'],
-                         stderr=subprocess.DEVNULL, check=False)
-        except:
-            pass
+        if self._profile_path:
+            try:
+                self.profile_manager().UnregisterProfile(self._profile_path)
+            except:
+                pass
+            self._profile_path = None
 
         if self.client_sock:
             try:
@@ -247,6 +432,9 @@ class DaemonGPSTracker:
             except:
                 pass
 
+        if self.accept_sel:
+            self.accept_sel.close()
+
         if self.server_sock:
             try:
                 self.server_sock.close()